@@ -4,10 +4,13 @@
 
 """This class manages the sysbench systemd service."""
 
+import functools
 import logging
 import os
 import shutil
+import signal
 import subprocess
+import zipfile
 from typing import Any, Dict, List
 
 import ops
@@ -20,7 +23,13 @@ from charms.operator_libs_linux.v1.systemd import (
     service_running,
     service_stop,
 )
-from jinja2 import Environment, FileSystemLoader, exceptions
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    exceptions,
+)
 from ops.charm import CharmEvents
 from ops.framework import EventBase, EventSource
 from ops.main import main
@@ -36,23 +45,106 @@ TPCC_SCRIPT = "script"
 SYSBENCH_SVC = "sysbench"
 SYSBENCH_PATH = f"/etc/systemd/system/{SYSBENCH_SVC}.service"
 DATABASE_NAME = "sysbench-db"
+TEMPLATES_DIR = os.path.join(os.environ.get("CHARM_DIR", ""), "templates")
+JINJA_CACHE_DIR = "/var/lib/charm/jinja_cache"
 
 DATABASE_RELATION = "database"
 COS_AGENT_RELATION = "cos-agent"
 
 
-def _render(src_template_file: str, dst_filepath: str, values: Dict[str, Any]):
-    templates_dir = os.path.join(os.environ.get("CHARM_DIR", ""), "templates")
-    template_env = Environment(loader=FileSystemLoader(templates_dir))
+@functools.lru_cache(maxsize=None)
+def _template_env() -> Environment:
+    # Each hook is a new process: persist compiled templates so only the first render parses
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    # Templates are config files, not HTML, and never change during a hook: skip autoescaping
+    # and the template mtime checks, and keep the trailing newline systemd units expect
+    return Environment(
+        loader=FileSystemLoader(TEMPLATES_DIR),
+        bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR, "%s.cache"),
+        autoescape=False,
+        auto_reload=False,
+        keep_trailing_newline=True,
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _get_template(src_template_file: str) -> Template:
+    return _template_env().get_template(src_template_file)
+
+
+def _render(src_template_file: str, dst_filepath: str, values: Dict[str, Any]) -> bool:
+    """Render the template into dst_filepath.
+
+    Returns False, leaving the file untouched, if it already has the rendered content.
+    """
     try:
-        template = template_env.get_template(src_template_file)
-        content = template.render(values)
+        template = _get_template(src_template_file)
+        content = template.render(values).encode()
     except exceptions.TemplateNotFound as e:
         raise e
-    # save the file in the destination
-    with open(dst_filepath, "w") as f:
-        f.write(content)
-        os.chmod(dst_filepath, 0o640)
+    try:
+        with open(dst_filepath, "rb") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    # write the file next to its destination with its final mode, then swap it in atomically
+    tmp_filepath = f"{dst_filepath}.tmp"
+    fd = os.open(tmp_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o640)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_filepath, dst_filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
+    return True
+
+
+def _run_streaming(cmd: List[str]):
+    """Run cmd, forwarding its output to the log line by line instead of buffering it.
+
+    cmd runs in its own process group, which is terminated if the hook receives a SIGTERM,
+    so that a cancelled hook does not leave sysbench running behind it. The call then fails
+    whatever the exit status of cmd, so the hook does not carry on with a partial result.
+    """
+    terminated = False
+
+    def _terminate(*_):
+        nonlocal terminated
+        terminated = True
+        os.killpg(proc.pid, signal.SIGTERM)
+
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+        start_new_session=True,
+    ) as proc:
+        assert proc.stdout is not None
+        previous_handler = signal.signal(signal.SIGTERM, _terminate)
+        try:
+            for line in proc.stdout:
+                logger.debug("%s: %s", os.path.basename(cmd[0]), line.rstrip())
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+    if terminated:
+        raise subprocess.CalledProcessError(proc.returncode or -signal.SIGTERM, cmd)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def _needs_daemon_reload(service_name: str) -> bool:
+    """Return whether systemd has not loaded the current unit file of the service yet."""
+    output = subprocess.run(
+        ["systemctl", "show", "--property=NeedDaemonReload", "--value", service_name],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    return output.strip() == "yes"
 
 
 class SetupBenchmarkEvent(EventBase):
@@ -76,6 +168,7 @@ class SysbenchPerfOperator(ops.CharmBase):
         super().__init__(*args)
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.sysbench_run_action, self.on_benchmark_run_action)
         self.framework.observe(self.on.setup_benchmark_event, self.setup_benchmark)
 
@@ -92,10 +185,6 @@ class SysbenchPerfOperator(ops.CharmBase):
             refresh_events=[],
         )
 
-    def __del__(self):
-        """Set status for the operator and finishes the service."""
-        self.unit.status = self.status()
-
     def status(self):
         """Return the status of the service."""
         if not self.database.fetch_relation_data():
@@ -106,22 +195,35 @@ class SysbenchPerfOperator(ops.CharmBase):
             return ops.model.WaitingStatus("Waiting for benchmark action to run")
         return ops.model.ActiveStatus()
 
+    def _set_charm_status(self):
+        """Set the unit status from the current state of the service."""
+        self.unit.status = self.status()
+
     @property
     def is_tls_enabled(self):
         """Return tls status."""
         return False
 
-    @property
+    @functools.cached_property
     def _unit_ip(self) -> str:
         """Current unit ip."""
         return self.model.get_binding(COS_AGENT_RELATION).network.bind_address
 
+    @functools.cached_property
+    def _labels(self) -> str:
+        """Comma-separated model and unit labels attached to the benchmark metrics."""
+        return ",".join([self.model.name, self.unit.name])
+
     def _on_config_changed(self, _):
         # For now, ignore the configuration
-        pass
+        self._set_charm_status()
+
+    def _on_update_status(self, _):
+        self._set_charm_status()
 
     def _on_relation_broken(self, _):
         service_stop(SYSBENCH_SVC)
+        self._set_charm_status()
 
     def scrape_config(self) -> List[Dict]:
         """Generate scrape config for the Patroni metrics endpoint."""
@@ -140,25 +242,48 @@ class SysbenchPerfOperator(ops.CharmBase):
         No exceptions are captured as we need all the dependencies below to even start running.
         """
         apt.update()
-        apt.add_package(["sysbench", "python3-prometheus-client", "python3-jinja2", "unzip"])
-        shutil.copyfile("templates/sysbench_svc.py", "/usr/bin/sysbench_svc.py")
-        os.chmod("/usr/bin/sysbench_svc.py", 0o700)
+        apt.add_package(["sysbench", "python3-prometheus-client", "python3-jinja2"])
+        # Create the script with its final mode and copy it in-kernel: it handles DB credentials
+        src_fd = os.open("templates/sysbench_svc.py", os.O_RDONLY)
+        try:
+            dst_fd = os.open(
+                "/usr/bin/sysbench_svc.py", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o700
+            )
+            try:
+                # The mode only applies on creation, enforce it on an existing copy too
+                os.fchmod(dst_fd, 0o700)
+                size, offset = os.fstat(src_fd).st_size, 0
+                while offset < size:
+                    sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                    if not sent:
+                        raise OSError("templates/sysbench_svc.py shrank while being copied")
+                    offset += sent
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        self._set_charm_status()
 
     def on_benchmark_run_action(self, event):
         """Run benchmark action."""
         self.duration = event.params.get("duration", 0)
         # copy the tpcc file
         tpcc_filepath = self.model.resources.fetch(TPCC_SCRIPT)
-        try:
-            subprocess.check_output(
-                ["unzip", "-o", "-j", tpcc_filepath, "-d", "/usr/share/sysbench/"]
-            )
-        except Exception as e:
-            raise e
+        with zipfile.ZipFile(tpcc_filepath) as archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                # Flatten the archive layout into the sysbench scripts folder
+                dst_filepath = os.path.join(
+                    "/usr/share/sysbench/", os.path.basename(member.filename)
+                )
+                with archive.open(member) as src, open(dst_filepath, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
 
         if not os.path.exists("/usr/share/sysbench/tpcc.lua"):
             raise Exception()
         self.on.setup_benchmark_event.emit()
+        self._set_charm_status()
 
     def setup_benchmark(self, event):
         """Set up benchmark systemd service."""
@@ -172,98 +297,66 @@ class SysbenchPerfOperator(ops.CharmBase):
         if service_running(SYSBENCH_SVC):
             service_stop(SYSBENCH_SVC)
 
-        db = self._database_config
+        options = self._sysbench_options(self._database_config)
 
-        _extra_labels = ",".join([self.model.name, self.unit.name])
+        self.unit.status = ops.model.MaintenanceStatus("Running clean and prepare commands...")
+        # Clean up is best effort and runs in the same process as prepare
+        _run_streaming(self._sysbench_svc_cmd(options, "clean,prepare"))
 
-        try:
-            # Attempt clean up
-            subprocess.check_output(
-                [
-                    "/usr/bin/sysbench_svc.py",
-                    "--tpcc_script=/usr/share/sysbench/tpcc.lua",
-                    "--db_driver=mysql",
-                    f"--threads={self.config['threads']}",
-                    f"--tables={self.config['tables']}",
-                    f"--scale={self.config['scale']}",
-                    f"--db_name={DATABASE_NAME}",
-                    f"--db_user={db['user']}",
-                    f"--db_password={db['password']}",
-                    f"--db_host={db['host']}",
-                    f"--db_port={db['port']}",
-                    f"--duration={self.config['duration']}",
-                    "--command=clean",
-                    f"--extra_labels={_extra_labels}",
-                ],
-                timeout=86400,
-            )
-        except Exception:
-            pass
-        self.unit.status = ops.model.MaintenanceStatus("Running prepare command...")
-
-        subprocess.check_output(
-            [
-                "/usr/bin/sysbench_svc.py",
-                "--tpcc_script=/usr/share/sysbench/tpcc.lua",
-                "--db_driver=mysql",
-                f"--threads={self.config['threads']}",
-                f"--tables={self.config['tables']}",
-                f"--scale={self.config['scale']}",
-                f"--db_name={DATABASE_NAME}",
-                f"--db_user={db['user']}",
-                f"--db_password={db['password']}",
-                f"--db_host={db['host']}",
-                f"--db_port={db['port']}",
-                f"--duration={self.config['duration']}",
-                "--command=prepare",
-                f"--extra_labels={_extra_labels}",
-            ],
-            timeout=86400,
-        )
+        # Render the systemd service file, systemd only needs a reload if it changed or if a
+        # previous reload of it failed
+        changed = _render("sysbench.service.j2", SYSBENCH_PATH, options)
+        if changed or _needs_daemon_reload(SYSBENCH_SVC):
+            daemon_reload()
+        # The service was stopped for the prepare step, so always restart it
+        service_restart(SYSBENCH_SVC)
+        self._set_charm_status()
+
+    def _sysbench_options(self, db: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the sysbench_svc.py options, shared by its command line and the service file."""
+        return {
+            "db_driver": "mysql",
+            "threads": self.config["threads"],
+            "tables": self.config["tables"],
+            "scale": self.config["scale"],
+            "db_name": DATABASE_NAME,
+            "db_user": db["user"],
+            "db_password": db["password"],
+            "db_host": db["host"],
+            "db_port": db["port"],
+            "duration": self.config["duration"],
+            "extra_labels": self._labels,
+        }
 
-        # Render the systemd service file
-        _render(
-            "sysbench.service.j2",
-            SYSBENCH_PATH,
-            {
-                "db_driver": "mysql",
-                "threads": self.config["threads"],
-                "tables": self.config["tables"],
-                "scale": self.config["scale"],
-                "db_name": DATABASE_NAME,
-                "db_user": db["user"],
-                "db_password": db["password"],
-                "db_host": db["host"],
-                "db_port": db["port"],
-                "duration": self.config["duration"],
-                "extra_labels": _extra_labels,
-            },
+    def _sysbench_svc_cmd(self, options: Dict[str, Any], command: str) -> List[str]:
+        """Build the sysbench_svc.py command line for the given options and command."""
+        return (
+            ["/usr/bin/sysbench_svc.py", "--tpcc_script=/usr/share/sysbench/tpcc.lua"]
+            + [f"--{key}={value}" for key, value in options.items()]
+            + [f"--command={command}"]
         )
-        # Reload and restart service now
-        daemon_reload()
-        service_restart(SYSBENCH_SVC)
-        self.unit.status = ops.model.ActiveStatus("Sysbench service is running")
 
     def on_benchmark_stop_action(self, _):
         """Stop benchmark service."""
         service_stop(SYSBENCH_SVC)
+        self._set_charm_status()
 
     def _on_endpoints_changed(self, _) -> None:
         # TODO: update the service if it is already running
-        pass
+        self._set_charm_status()
 
-    @property
+    @functools.cached_property
     def _database_config(self):
         """Returns the database config to use to connect to the MySQL cluster."""
         # identify the database relation
-        data = list(self.database.fetch_relation_data().values())[0]
+        data = next(iter(self.database.fetch_relation_data().values()))
 
         username, password, endpoints = (
             data.get("username"),
             data.get("password"),
             data.get("endpoints"),
         )
-        if None in [username, password, endpoints]:
+        if username is None or password is None or endpoints is None:
             return {}
 
         config = {
@@ -271,10 +364,15 @@ class SysbenchPerfOperator(ops.CharmBase):
             "password": password,
             "database": DATABASE_NAME,
         }
-        if endpoints.startswith("file://"):
-            config["unix_socket"] = endpoints[7:]
+        # endpoints may list several comma-separated addresses, connect to the first one
+        endpoint = endpoints.split(",")[0]
+        scheme, sep, rest = endpoint.partition("://")
+        if scheme == "file" and sep:
+            config["unix_socket"] = rest
         else:
-            host, port = endpoints.split(":")
+            host, port_sep, port = (rest if sep else endpoint).rpartition(":")
+            if not port_sep:
+                raise ValueError(f"Database endpoint {endpoint} has no port")
             config["host"] = host
             config["port"] = port
 
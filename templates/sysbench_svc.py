@@ -5,10 +5,24 @@
 """This method runs the sysbench call, collects its output and forwards to prometheus."""
 
 import argparse
+import re
 import signal
 import subprocess
+import sys
 
-from prometheus_client import Gauge, start_http_server
+from prometheus_client import CollectorRegistry, Gauge, start_http_server
+
+# Only expose the benchmark gauges: the default registry also collects process, platform and
+# GC metrics on every scrape, which are irrelevant to the benchmark
+REGISTRY = CollectorRegistry()
+
+# Matches sysbench's periodic report lines, e.g.:
+# [ 10s ] thds: 8 tps: 10.50 qps: 210.90 (r/w/o: ...) lat (ms,95%): 8.43 err/s: 0.00 reconn/s: 0.00
+REPORT_LINE_RE = re.compile(
+    r"tps:\s+(?P<tps>\S+)\s+qps:\s+(?P<qps>\S+).*?"
+    r"lat \(ms,95%\):\s+(?P<latency>\S+)\s+"
+    r"err/s:?\s+(?P<errors>\S+)\s+reconn/s:\s+(?P<reconn>\S+)"
+)
 
 
 class SysbenchService:
@@ -29,41 +43,64 @@ class SysbenchService:
         duration: int = 0,
     ):
         self.tpcc_script = tpcc_script
-        self.sysbench = f"/usr/bin/sysbench {tpcc_script} --threads={threads} --tables={tables} --scale={scale} --force_pk=1 --db-driver={db_driver} --report-interval=10 --time={duration} "
+        self.sysbench = (
+            "/usr/bin/sysbench",
+            tpcc_script,
+            f"--threads={threads}",
+            f"--tables={tables}",
+            f"--scale={scale}",
+            "--force_pk=1",
+            f"--db-driver={db_driver}",
+            "--report-interval=10",
+            f"--time={duration}",
+        )
         if db_driver == "mysql":
-            self.sysbench += f"--mysql-db={db_name} --mysql-user={db_user} --mysql-password={db_password} --mysql-host={db_host} --mysql-port={db_port}"
+            self.sysbench += (
+                f"--mysql-db={db_name}",
+                f"--mysql-user={db_user}",
+                f"--mysql-password={db_password}",
+                f"--mysql-host={db_host}",
+                f"--mysql-port={db_port}",
+            )
         else:
             raise Exception("Wrong db driver chosen")
 
     def _exec(self, cmd):
-        subprocess.check_output(self.sysbench.split(" ") + cmd, timeout=86400)
+        # Inherit stdout so the output reaches the caller as it is produced, not buffered here
+        subprocess.run(self.sysbench + tuple(cmd), check=True, timeout=86400)
 
     def prepare(self):
         """Prepare the sysbench output."""
         return self._exec(["prepare"])
 
     def _process_line(self, line):
-        if "tps" not in line or "qps" not in line or "lat" not in line:
+        match = REPORT_LINE_RE.search(line)
+        if not match:
             # This line does not have any data of interest
             return None
         return {
-            "tps": line.split("tps: ")[1].split()[0],
-            "qps": line.split("qps: ")[1].split()[0],
-            "95p_latency": line.split("lat (ms,95%): ")[1].split()[0],
-            "err-per-sec": line.split("err/s ")[1].split()[0],
-            "reconn-per-sec": line.split("reconn/s: ")[1],
+            "tps": match["tps"],
+            "qps": match["qps"],
+            "95p_latency": match["latency"],
+            "err-per-sec": match["errors"],
+            "reconn-per-sec": match["reconn"],
         }
 
     def run(self, proc, metrics, label, extra_labels):
-        """Run one step of the main sysbench service loop."""
+        """Update the metrics with each report line until sysbench closes its output."""
+        # The labels are fixed for the life of the service: bind the gauges before the first line
+        gauges = {}
+        for m in ["tps", "qps", "95p_latency"]:
+            register_benchmark_metric(
+                metrics, f"{label}_{m}", extra_labels, f"tpcc metrics for {m}"
+            )
+            gauges[m] = metrics[f"{label}_{m}"]
         for line in iter(proc.stdout.readline, ""):
             value = self._process_line(line)
             if not value:
                 continue
-            for m in ["tps", "qps", "95p_latency"]:
-                add_benchmark_metric(
-                    metrics, f"{label}_{m}", extra_labels, f"tpcc metrics for {m}", value[m]
-                )
+            for m, gauge in gauges.items():
+                gauge.set(value[m])
 
     def stop(self, proc):
         """Stop the service with SIGTERM."""
@@ -74,23 +111,65 @@ class SysbenchService:
         self._exec(["cleanup"])
 
 
-def add_benchmark_metric(metrics, label, extra_labels, description, value):
-    """Add the benchmark to the prometheus metric.
+def register_benchmark_metric(metrics, label, extra_labels, description):
+    """Register the benchmark prometheus metric, bound to the extra labels.
 
     labels:
         tpcc_{db_driver}_{tps|qps|95p_latency}
     """
     if label not in metrics:
-        metrics[label] = Gauge(label, description, ["model", "unit"])
-    metrics[label].labels(*extra_labels).set(value)
+        gauge = Gauge(label, description, ["model", "unit"], registry=REGISTRY)
+        metrics[label] = gauge.labels(*extra_labels)
+
+
+def _run_command(svc, args, command, chained, run_started):
+    """Run one sysbench_svc command, run_started is called with the sysbench run process."""
+    if command == "prepare":
+        svc.prepare()
+    elif command == "run":
+        proc = subprocess.Popen(
+            svc.sysbench + ("run",),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            bufsize=1,
+        )
+        run_started(proc)
+        metrics = {}
+        # Consumes the report lines as they come, returns once sysbench exits
+        svc.run(proc, metrics, f"tpcc_{args.db_driver}", args.extra_labels)
+        proc.wait()
+    elif command == "clean":
+        try:
+            svc.clean()
+        except subprocess.CalledProcessError:
+            # Best effort when chained: there may be nothing to clean up yet
+            if not chained:
+                raise
+    else:
+        raise Exception(f"Command option {command} not known")
 
 
 def main(args):
     """Run main method."""
     keep_running = True
-
-    def _exit(*args, **kwargs):
-        keep_running = False  # noqa: F841
+    stop_signal = None
+    proc = None
+
+    def _exit(signum, frame):
+        nonlocal keep_running, stop_signal
+        keep_running = False
+        stop_signal = signum
+        if proc is not None and proc.poll() is None:
+            # sysbench closes its output once stopped, which ends the run loop
+            svc.stop(proc)
+
+    def _run_started(run_proc):
+        nonlocal proc
+        proc = run_proc
+        if not keep_running:
+            # The stop arrived while sysbench was being started, before _exit could see it
+            svc.stop(proc)
 
     svc = SysbenchService(
         tpcc_script=args.tpcc_script,
@@ -108,26 +187,18 @@ def main(args):
 
     signal.signal(signal.SIGINT, _exit)
     signal.signal(signal.SIGTERM, _exit)
-    start_http_server(8088)
+    start_http_server(8088, registry=REGISTRY)
 
-    if args.command == "prepare":
-        svc.prepare()
-        keep_running = False  # Gracefully shutdown
-    elif args.command == "run":
-        proc = subprocess.Popen(
-            svc.sysbench.split(" ") + ["run"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-        )
-        metrics = {}
-        while keep_running:
-            svc.run(proc, metrics, f"tpcc_{args.db_driver}", args.extra_labels.split(","))
-    elif args.command == "clean":
-        svc.clean()
-    else:
-        raise Exception(f"Command option {args.command} not known")
+    # Several commands can be chained, e.g. "clean,prepare", to run them in a single process
+    commands = args.command.split(",")
+    for command in commands:
+        if not keep_running:
+            break
+        _run_command(svc, args, command, len(commands) > 1, _run_started)
+
+    if not keep_running:
+        # Stopped before the commands completed: do not let the caller take this as a success
+        sys.exit(128 + stop_signal)
 
 
 if __name__ == "__main__":
@@ -145,9 +216,13 @@ if __name__ == "__main__":
     parser.add_argument("--db_host", type=str)
     parser.add_argument("--db_port", type=int)
     parser.add_argument("--duration", type=int)
-    parser.add_argument("--command", type=str)
     parser.add_argument(
-        "--extra_labels", type=str, help="comma-separated list of extra labels to be used."
+        "--command", type=str, help="comma-separated list of commands to run in order."
+    )
+    parser.add_argument(
+        "--extra_labels",
+        type=lambda s: s.split(","),
+        help="comma-separated list of extra labels to be used.",
     )
 
     args = parser.parse_args()